@@ -1,9 +1,28 @@
-from data_preprocessing import load_all_data
-from src.segmentation import segment_ecg_by_condition
-from src.hrv_metrics import compute_hrv_features
+from src.data_preprocessing import load_all_data
+from src.segmentation import segmentation_ecg, clean_segment, remove_short_segments, save_segments, load_segments, segments_cache_is_fresh
+from src.hrv_metrics import multi_extract_hrv_metrics
+
+DATA_DIR = "data/"
+SEGMENTS_CACHE = "cache/segments/"
+SAMPLING_RATE = 250
+CLEANING_METHODS = ['neurokit', 'biosppy']
+SEGMENTS_OF_INTEREST = ['fixation_cross', 'C', '0B', '2B']
+# Some cleaning filters need a few seconds of signal
+MIN_LENGTH = 2000
+PIPELINE_PARAMS = {'cleaning_methods': CLEANING_METHODS, 'sampling_rate': SAMPLING_RATE, 'min_length': MIN_LENGTH}
 
 
 if __name__ == "__main__":
-    df_raw = load_all_data("data/")
-    df_segments = segment_ecg_by_condition(df_raw, "data/logs/")
-    df_hrv = compute_hrv_features(df_segments)
+    if segments_cache_is_fresh(SEGMENTS_CACHE, DATA_DIR, PIPELINE_PARAMS):
+        cleaned_segments = load_segments(SEGMENTS_CACHE)
+    else:
+        participants_data, _, _, _ = load_all_data(DATA_DIR)
+        all_segments = {participant: segmentation_ecg(ecg_df, log_event_df)
+                        for participant, (ecg_df, log_event_df) in participants_data.items()}
+        all_segments, _ = remove_short_segments(all_segments, {}, min_length=MIN_LENGTH)
+        cleaned_segments = {participant: {method: {segment_name: clean_segment(segment, SAMPLING_RATE, method)
+                                                   for segment_name, segment in segments.items()}
+                                          for method in CLEANING_METHODS}
+                            for participant, segments in all_segments.items()}
+        save_segments(cleaned_segments, SEGMENTS_CACHE, DATA_DIR, PIPELINE_PARAMS)
+    hrv_metrics_dict, df_hrv = multi_extract_hrv_metrics(cleaned_segments, SEGMENTS_OF_INTEREST)
@@ -1,13 +1,38 @@
 import os
+import glob
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import scipy.signal
+from numba import njit
 import neurokit2 as nk
 
-def load_data_for_participant(participant_folder):
+MS_PER_DAY = 86_400_000
+
+def time_of_day_ms(datetimes):
+    """
+    Converts a datetime Series into milliseconds elapsed since midnight.
+
+    Args:
+        datetimes (pd.Series): Series of datetime64 values.
+
+    Returns:
+        np.ndarray: Time of day in milliseconds (int64).
+    """
+    ns = np.asarray(datetimes.values, dtype='datetime64[ns]').view('int64')
+    return (ns // 1_000_000) % MS_PER_DAY
+
+def load_data_for_participant(participant_folder, use_pyarrow=True):
     """
     Loads the ECG, log_event, and cognitive evaluation files for a given participant.
 
     Args:
         participant_folder (str): Path to the participant's folder.
+        use_pyarrow (bool, optional): If True, parses the (large) ECG file with the PyArrow CSV reader
+            instead of the pandas C engine. Defaults to True.
 
     Returns:
         tuple: DataFrames for the ECG signal, experimental interface timestamps, and subjective measures.
@@ -19,45 +44,45 @@ def load_data_for_participant(participant_folder):
     error_path = os.path.join(participant_folder, f"Tableau_suivi_erreur_{participant_id}.csv")
     
 
-    ecg_file = None
-    if os.path.exists(ecg_folder):
-        for file in os.listdir(ecg_folder):
-            if 'ECG' in file and file.endswith('.csv'):
-                ecg_file = os.path.join(ecg_folder, file)
-                break
+    matches = glob.glob(os.path.join(glob.escape(ecg_folder), '*ECG*.csv'))
+    ecg_file = matches[0] if matches else None
 
-    if ecg_file and os.path.exists(log_event_path) and os.path.exists(cog_evals_path):
-        ecg_df = pd.read_csv(ecg_file, sep=',')
+    if ecg_file and os.path.isfile(log_event_path) and os.path.isfile(cog_evals_path):
+        if use_pyarrow:
+            ecg_df = pacsv.read_csv(ecg_file, parse_options=pacsv.ParseOptions(delimiter=',')).to_pandas(split_blocks=True, self_destruct=True)
+        else:
+            ecg_df = pd.read_csv(ecg_file, sep=',')
+        ecg_df['EcgWaveform'] = ecg_df['EcgWaveform'].astype(np.float32)
         log_event_df = pd.read_csv(log_event_path, sep=';')
         cog_evals_df = pd.read_csv(cog_evals_path, sep=';')
-        if os.path.exists(error_path):
+        error_df = None
+        if os.path.isfile(error_path):
             error_df = pd.read_csv(error_path, sep=';', encoding='iso-8859-1')
         else:
             print(f"missing error file from this participant : {participant_id} !!\n"
                   + "or there is some mistake going on with it, check extension issues")
 
         # Conversion des timestamps en datetime
-        ecg_df['Time'] = pd.to_datetime(ecg_df['Time'], format='%d/%m/%Y %H:%M:%S.%f')
-        log_event_df['datetime'] = pd.to_datetime(log_event_df['datetime'], format='%Y-%m-%d %H:%M:%S.%f')
+        ecg_df['Time'] = pd.to_datetime(ecg_df['Time'], format='%d/%m/%Y %H:%M:%S.%f', cache=True, exact=True)
+        log_event_df['datetime'] = pd.to_datetime(log_event_df['datetime'], format='ISO8601')
         
         # Conversion des timestamps en millisecondes
-        ecg_df['timestamp_ms'] = ecg_df['Time'].dt.hour * 3600000 + ecg_df['Time'].dt.minute * 60000 + \
-                                 ecg_df['Time'].dt.second * 1000 + ecg_df['Time'].dt.microsecond // 1000
-
-        log_event_df['timestamp_ms'] = log_event_df['datetime'].dt.hour * 3600000 + log_event_df['datetime'].dt.minute * 60000 + \
-                                       log_event_df['datetime'].dt.second * 1000 + log_event_df['datetime'].dt.microsecond // 1000
+        ecg_df['timestamp_ms'] = time_of_day_ms(ecg_df['Time'])
+        log_event_df['timestamp_ms'] = time_of_day_ms(log_event_df['datetime'])
 
         return ecg_df, log_event_df, cog_evals_df, error_df
     else:
         print(f"Missing files for this participant : {participant_folder}")
-        return None, None, None
+        return None, None, None, None
 
-def load_all_data(participants_root_folder):
+def load_all_data(participants_root_folder, max_workers=None):
     """
     Loads the ECG, log_event, and cognitive evaluation files for all participants in the root folder.
+    Participants are loaded in parallel in a process pool.
 
     Args:
         participants_root_folder (str): Path to the root directory containing all participant folders.
+        max_workers (int, optional): Maximum number of worker processes. Defaults to None (number of CPUs).
 
     Returns:
         dict: Dictionary with participant names as keys and tuples 
@@ -66,18 +91,23 @@ def load_all_data(participants_root_folder):
     participants_data = {}
     participants_subj_data = {}
     participants_error_data = {}
-    
-    for participant_folder in os.listdir(participants_root_folder):
-        full_path = os.path.join(participants_root_folder, participant_folder)
-        if os.path.isdir(full_path):
-            ecg_df, log_event_df, cog_evals_df, error_df = load_data_for_participant(full_path)
-            if ecg_df is not None and log_event_df is not None:
-                participants_data[participant_folder] = (ecg_df, log_event_df)
-            if cog_evals_df is not None:
-                participants_subj_data[participant_folder] = (cog_evals_df)
-            if error_df is not None:
-                participants_error_data[participant_folder] = (error_df)
-            
+
+    with os.scandir(participants_root_folder) as entries:
+        participant_folders = [entry.name for entry in entries if entry.is_dir()]
+    full_paths = [os.path.join(participants_root_folder, folder) for folder in participant_folders]
+
+    # Each participant is an independent parsing job
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(load_data_for_participant, full_paths))
+
+    for participant_folder, (ecg_df, log_event_df, cog_evals_df, error_df) in zip(participant_folders, results):
+        if ecg_df is not None and log_event_df is not None:
+            participants_data[participant_folder] = (ecg_df, log_event_df)
+        if cog_evals_df is not None:
+            participants_subj_data[participant_folder] = (cog_evals_df)
+        if error_df is not None:
+            participants_error_data[participant_folder] = (error_df)
+
     if os.path.exists("./Participants.csv"):
         annex_data = pd.read_csv("./Participants.csv", sep=';', encoding='iso-8859-1')
     else:
@@ -97,7 +127,13 @@ def extract_errors(error_data, export=False):
     Returns:
         pd.DataFrame: A DataFrame summarizing the number of errors by participant, segment, and error type.
     """
-    data_list = []
+    # Upper bound: one zero-count row per (error type, segment) plus one row per marked cell
+    n_max = sum(df.shape[0] * (df.shape[1] + 3) for df in error_data.values())
+    participants = np.empty(n_max, dtype=object)
+    types = np.empty(n_max, dtype=object)
+    segments = np.empty(n_max, dtype=object)
+    counts = np.zeros(n_max, dtype=np.int32)
+    n = 0
 
     for participant_id, df in error_data.items():
         task_names = df.iloc[0].tolist()
@@ -116,36 +152,55 @@ def extract_errors(error_data, export=False):
                     task_positions[correspondance[tmp]] = pos_col
             pos_col += 1
 
-        error_types = df.iloc[1:, 0].unique()
-        for error_type in error_types:
-            for segment in task_positions.keys():
-                data_list.append([participant_id, error_type, segment, 0])
-
-        for index, row in df.iterrows():
-            if index < 1:
+        # Column position -> segment, each task spanning the columns up to the next one
+        segment_of_column = {}
+        for segment, start_pos in task_positions.items():
+            if start_pos is None:
                 continue
-
-            error_type = row.iloc[0]
-
-            for segment, start_pos in task_positions.items():
-                if start_pos is None:
-                    continue
-                if start_pos == 1:
-                    end_pos = 8
-                elif start_pos == 8:
-                    end_pos = 15
-                elif start_pos == 15:
-                    end_pos = len(row)
-                for i in range(start_pos, end_pos):
-                    if row.iloc[i] == 'X':
-                        data_list.append([participant_id, error_type, segment, 1])
-
-    error_df = pd.DataFrame(data_list, columns=['Participant', 'Type', 'Segment', 'Count'])
-
-    error_count_df = error_df.groupby(['Participant', 'Segment', 'Type']).sum().unstack(fill_value=0)
-    error_count_df.columns = error_count_df.columns.droplevel()
+            if start_pos == 1:
+                end_pos = 8
+            elif start_pos == 8:
+                end_pos = 15
+            elif start_pos == 15:
+                end_pos = df.shape[1]
+            for i in range(start_pos, end_pos):
+                segment_of_column[i] = segment
+
+        error_types = np.asarray(df.iloc[1:, 0].unique(), dtype=object)
+        task_segments = np.array(list(task_positions.keys()), dtype=object)
+        n_init = len(error_types) * len(task_segments)
+        participants[n:n + n_init] = participant_id
+        types[n:n + n_init] = np.repeat(error_types, len(task_segments))
+        segments[n:n + n_init] = np.tile(task_segments, len(error_types))
+        n += n_init
+
+        body = df.iloc[1:].reset_index(drop=True)
+        mask = (body.iloc[:, 1:] == 'X').to_numpy()
+        rows, cols = np.nonzero(mask)
+        hit_segments = pd.Series(cols + 1).map(segment_of_column).to_numpy(dtype=object)
+        in_task = ~pd.isna(hit_segments)
+        n_hits = int(in_task.sum())
+        participants[n:n + n_hits] = participant_id
+        types[n:n + n_hits] = body.iloc[rows[in_task], 0].to_numpy(dtype=object)
+        segments[n:n + n_hits] = hit_segments[in_task]
+        counts[n:n + n_hits] = 1
+        n += n_hits
+
+    error_df = pd.DataFrame({
+        'Participant': participants[:n],
+        'Type': types[:n],
+        'Segment': segments[:n],
+        'Count': counts[:n]
+    })
+
+    # Hash aggregation on Arrow string columns, then pivot the (small) result in pandas
+    keys = ['Participant', 'Segment', 'Type']
+    # Arrow keeps null keys (e.g. blank rows at the end of the sheet), pandas groupby dropped them
+    error_df = error_df.dropna(subset=keys)
+    summed = pa.Table.from_pandas(error_df, preserve_index=False).group_by(keys).aggregate([('Count', 'sum')]).to_pandas()
+    error_count_df = summed.set_index(keys)['Count_sum'].unstack(fill_value=0).sort_index()
     error_count_df['Total Errors'] = error_count_df.sum(axis=1)
-    error_count_df = error_count_df.fillna(0).astype(int)
+    error_count_df = error_count_df.astype(int)
 
     if export: 
         error_count_df.to_csv("error_summary.csv", sep=";")
@@ -165,16 +220,18 @@ def extract_subjective_evaluations(subj_data, export=False):
         pd.DataFrame: A pivoted DataFrame containing subjective workload metrics (NASA-TLX) 
                       by participant and experimental segment.
     """
-    data_list = []
+    frames = []
 
     for participant, df in subj_data.items():
-        for _, row in df.iterrows():
-            item = row['items']
-            value = row['values']
-            measure, segment = item.rsplit('_', 1)
-            data_list.append([participant, segment, measure, value])
+        splits = df['items'].str.rsplit('_', n=1, expand=True)
+        frames.append(pd.DataFrame({
+            'Participant': participant,
+            'Segment': splits[1].to_numpy(),
+            'NASA_TLX_Metric': splits[0].to_numpy(),
+            'Value': df['values'].to_numpy()
+        }))
 
-    df = pd.DataFrame(data_list, columns=['Participant', 'Segment', 'NASA_TLX_Metric', 'Value'])
+    df = pd.concat(frames, ignore_index=True)
 
     df_pivot = df.pivot_table(index=['Participant', 'Segment'], columns='NASA_TLX_Metric', values='Value')
 
@@ -195,14 +252,139 @@ def extract_subjective_evaluations(subj_data, export=False):
 
 
 
-def evaluate_ecg_quality(all_segments, cleaned_segments, rpeaks, export=False, verbose=False):
+@njit(cache=True)
+def _kurtosis(signal):
+    """Pearson kurtosis (kSQI) of a signal."""
+    centered = signal - signal.mean()
+    m2 = (centered ** 2).mean()
+    m4 = (centered ** 4).mean()
+    return m4 / (m2 * m2)
+
+@njit(cache=True)
+def _band_power(frequency, power, low, high):
+    """Trapezoidal power of the PSD within [low, high), NaN if empty."""
+    total = 0.0
+    previous = -1
+    for i in range(frequency.shape[0]):
+        if frequency[i] >= low and frequency[i] < high:
+            if previous >= 0:
+                total += 0.5 * (power[i] + power[previous]) * (frequency[i] - frequency[previous])
+            previous = i
+    return np.nan if total == 0.0 else total
+
+@njit(cache=True)
+def _zhao2018_fusion(kSQI, pSQI, basSQI, ecg_rate):
+    """Simple heuristic fusion of Zhao et al. (2018), returning the quality score."""
+    if ecg_rate < 130:
+        l1, l2, l3 = 0.5, 0.8, 0.4
+    else:
+        l1, l2, l3 = 0.4, 0.7, 0.3
+
+    if pSQI > l1 and pSQI < l2:
+        pSQI_class = 2
+    elif pSQI > l3 and pSQI < l1:
+        pSQI_class = 1
+    else:
+        pSQI_class = 0
+
+    kSQI_class = 2 if kSQI > 5 else 0
+
+    if basSQI >= 0.95:
+        basSQI_class = 2
+    elif basSQI < 0.9:
+        basSQI_class = 0
+    else:
+        basSQI_class = 1
+
+    n_optimal = 0
+    n_suspicious = 0
+    n_unqualified = 0
+    for sqi_class in (pSQI_class, kSQI_class, basSQI_class):
+        if sqi_class == 2:
+            n_optimal += 1
+        elif sqi_class == 1:
+            n_suspicious += 1
+        else:
+            n_unqualified += 1
+
+    if n_unqualified >= 2 or (n_unqualified == 1 and n_suspicious == 2):
+        return 0.1
+    elif n_optimal >= 2 and n_unqualified == 0:
+        return 1.0
+    else:
+        return 0.5
+
+def zhao2018_score(ecg_signal, sampling_rate=1000, window=1024):
+    """
+    Rates ECG signal quality following nk.ecg_quality(method="zhao2018"), returning the score directly.
+    The Welch PSD is computed once and shared by pSQI and basSQI.
+
+    Args:
+        ecg_signal (np.ndarray): ECG signal to rate.
+        sampling_rate (int, optional): Sampling rate passed to NeuroKit. Defaults to 1000 (NeuroKit's default).
+        window (int, optional): Welch window length in seconds. Defaults to 1024.
+
+    Returns:
+        float: 0.1 (Unacceptable), 0.5 (Barely acceptable) or 1.0 (Excellent).
+    """
+    _, info = nk.ecg_peaks(ecg_signal, sampling_rate=sampling_rate)
+    rpeaks = info["ECG_R_Peaks"]
+    if len(rpeaks) > 1:
+        ecg_rate = 60000.0 / (1000.0 / sampling_rate * np.min(np.diff(rpeaks)))
+    else:
+        ecg_rate = 1
+
+    # Same Welch settings as nk.signal_psd
+    centered = ecg_signal - np.mean(ecg_signal)
+    n = len(centered)
+    min_frequency = (2 * sampling_rate) / (n / 2)
+    nperseg = int(window * sampling_rate)
+    if nperseg > n / 2:
+        nperseg = int(n / 2)
+    frequency, power = scipy.signal.welch(centered, fs=sampling_rate, scaling="density", detrend=False,
+                                          nfft=int(nperseg * 2), average="mean", nperseg=nperseg, window="hann")
+    keep = frequency >= min_frequency
+    frequency = np.ascontiguousarray(frequency[keep], dtype=np.float64)
+    power = np.ascontiguousarray(power[keep], dtype=np.float64)
+
+    pSQI = _band_power(frequency, power, 5, 15) / _band_power(frequency, power, 5, 40)
+    basSQI = 1 - _band_power(frequency, power, 0, 1) / _band_power(frequency, power, 0, 40)
+    kSQI = _kurtosis(np.asarray(ecg_signal, dtype=np.float64))
+
+    return _zhao2018_fusion(kSQI, pSQI, basSQI, ecg_rate)
+
+def iter_quality_signals(all_segments, cleaned_segments, segments_of_interest):
+    """
+    Yields the ECG signals to rate, raw segments first then each cleaning method.
+
+    Args:
+        all_segments (dict): Dictionary of raw ECG segments per participant and condition.
+        cleaned_segments (dict): Dictionary of cleaned ECG segments per participant and preprocessing method.
+        segments_of_interest (list): Segment names to keep.
+
+    Yields:
+        tuple: (participant, method, segment, ecg_signal) with ecg_signal as a NumPy array.
+    """
+    for participant, segments in all_segments.items():
+        for segment, segment_df in segments.items():
+            if segment in segments_of_interest:
+                yield participant, 'no cleaning', segment, segment_df['EcgWaveform'].to_numpy()
+
+    for participant, methods in cleaned_segments.items():
+        for method, segments in methods.items():
+            for segment, segment_df in segments.items():
+                if segment in segments_of_interest:
+                    yield participant, method, segment, segment_df['EcgWaveform'].to_numpy()
+
+def evaluate_ecg_quality(all_segments, cleaned_segments, rpeaks=None, export=False, verbose=False):
     """
     Evaluates ECG signal quality before and after preprocessing for all participants and experimental segments.
 
     Args:
         all_segments (dict): Dictionary of raw ECG segments per participant and condition.
         cleaned_segments (dict): Dictionary of cleaned ECG segments per participant and preprocessing method.
-        rpeaks (dict): Dictionary of R-peak detection results (not directly used here, kept for compatibility).
+        rpeaks (dict, optional): Dictionary of R-peak detection results (not directly used here, kept for compatibility).
+            Defaults to None.
         export (bool, optional): If True, exports segment-level and global quality indices to CSV files. Defaults to False.
         verbose (bool, optional): If True, prints detailed processing information during analysis. Defaults to False.
 
@@ -211,70 +393,49 @@ def evaluate_ecg_quality(all_segments, cleaned_segments, rpeaks, export=False, v
             - pd.DataFrame: Detailed quality ratings per participant, method, and segment.
             - pd.DataFrame: Global quality index (average quality) for each participant and method.
     """
-    data = []
     segments_of_interest = ['fixation_cross', 'C', '0B', '2B']
+    n_signals = sum(segment in segments_of_interest
+                    for segments in all_segments.values() for segment in segments.keys())
+    n_signals += sum(segment in segments_of_interest
+                     for methods in cleaned_segments.values() for segments in methods.values() for segment in segments.keys())
+    data = {column: np.empty(n_signals, dtype=object) for column in ['Participant', 'Method', 'Segment', 'Quality']}
 
     quality_scores = {
         "Unacceptable": 0.1,
         "Barely acceptable": 0.5,
         "Excellent": 1
     }
+    quality_labels = {score: label for label, score in quality_scores.items()}
+
+    # Identical signals (e.g. the same segment reused across methods) are only rated once
+    quality_cache = {}
+    method_scores = {}
+
+    for i, (participant, method, segment, ecg_signal) in enumerate(iter_quality_signals(all_segments, cleaned_segments, segments_of_interest)):
+        if verbose:
+            if method == 'no cleaning':
+                print(f"Analyzing quality of segment {segment} from participant {participant}")
+            else:
+                print(f"Analyzing quality of segment {segment} cleaned by {method} from participant {participant}")
+        signal_key = (ecg_signal.dtype.str, hashlib.sha1(np.ascontiguousarray(ecg_signal)).digest())
+        if signal_key not in quality_cache:
+            quality_cache[signal_key] = zhao2018_score(ecg_signal)
+        score = quality_cache[signal_key]
+        quality = quality_labels[score]
+        method_scores.setdefault((participant, method), []).append(score)
+        data['Participant'][i] = participant
+        data['Method'][i] = method
+        data['Segment'][i] = segment
+        data['Quality'][i] = quality
 
     participant_method_quality_indices = []
-
-    for participant in all_segments.keys():
-        total_score = 0
-        count = 0
-        for segment in all_segments[participant].keys():
-            if segment in segments_of_interest:
-                ecg_signal = all_segments[participant][segment]['EcgWaveform'].values
-                quality = nk.ecg_quality(ecg_signal, method="zhao2018")
-                score = quality_scores[quality]
-                total_score += score
-                count += 1
-                if verbose:
-                    print(f"Analyzing quality of segment {segment} from participant {participant}")
-                data.append({
-                    'Participant': participant,
-                    'Method': 'no cleaning',
-                    'Segment': segment,
-                    'Quality': quality,
-                })
-        if count > 0:
-            average_quality_index = round(total_score / count, 2)
-            participant_method_quality_indices.append({
-                'Participant': participant,
-                'Method': 'no cleaning',
-                'Quality Index': average_quality_index
-            })
-
-    for participant in cleaned_segments.keys():
-        for method in cleaned_segments[participant].keys():
-            total_score = 0
-            count = 0
-            for segment in cleaned_segments[participant][method].keys():
-                if segment in segments_of_interest:
-                    ecg_signal = cleaned_segments[participant][method][segment]['EcgWaveform'].values
-                    quality = nk.ecg_quality(ecg_signal, method="zhao2018")
-                    score = quality_scores[quality]
-                    total_score += score
-                    count += 1
-                    if verbose:
-                        print(f"Analyzing quality of segment {segment} cleaned by {method} from participant {participant}")
-                    data.append({
-                        'Participant': participant,
-                        'Method': method,
-                        'Segment': segment,
-                        'Quality': quality,
-                    })
-            if count > 0:
-                average_quality_index = round(total_score / count, 2)
-                participant_method_quality_indices.append({
-                    'Participant': participant,
-                    'Method': method,
-                    'Quality Index': average_quality_index
-                })
-
+    for (participant, method), scores in method_scores.items():
+        average_quality_index = round(sum(scores) / len(scores), 2)
+        participant_method_quality_indices.append({
+            'Participant': participant,
+            'Method': method,
+            'Quality Index': average_quality_index
+        })
 
     df = pd.DataFrame(data)
     df.sort_values(by=['Participant', 'Method', 'Segment'], inplace=True)
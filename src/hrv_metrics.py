@@ -1,4 +1,6 @@
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 import neurokit2 as nk
 
 def extract_metrics_hrv(segment, method, fs=250):
@@ -14,7 +16,8 @@ def extract_metrics_hrv(segment, method, fs=250):
         dict: Dictionary containing computed HRV metrics.
         list: List containing the BPM values of the detected R-peaks.
     """
-    ecg_signals, info = nk.ecg_peaks(segment['EcgWaveform'], sampling_rate=fs, method=method)
+    ecg_signal = np.ascontiguousarray(segment['EcgWaveform'].to_numpy(), dtype=np.float32)
+    ecg_signals, info = nk.ecg_peaks(ecg_signal, sampling_rate=fs, method=method)
     hrv_temporal_metrics = nk.hrv_time(ecg_signals, sampling_rate=fs)
     hrv_frequency_metrics = nk.hrv_frequency(ecg_signals, sampling_rate=fs)
     hrv_metrics = pd.concat([hrv_temporal_metrics, hrv_frequency_metrics], axis=1)
@@ -23,7 +26,7 @@ def extract_metrics_hrv(segment, method, fs=250):
     return hrv_metrics, HR
 
 
-def multi_extract_hrv_metrics(cleaned_segments, segments_of_interest, cleaning_method_chosen='biosppy', cleaned=True, export=False, verbose=False):
+def multi_extract_hrv_metrics(cleaned_segments, segments_of_interest, cleaning_method_chosen='biosppy', cleaned=True, export=False, verbose=False, n_jobs=-1):
     """
     Extracts HRV metrics from all relevant ECG segments and stores them in a new HRV metrics dictionary.
 
@@ -37,16 +40,19 @@ def multi_extract_hrv_metrics(cleaned_segments, segments_of_interest, cleaning_m
             Defaults to True.
         export (bool, optional): If True, exports the compiled HRV metrics to a CSV file named "HRV_metrics.csv".
             Defaults to False.
-        verbose (bool, optional): If True, prints progress information during extraction.
+        verbose (bool, optional): If True, prints joblib progress information during extraction.
             Defaults to False.
+        n_jobs (int, optional): Number of joblib workers used to process the segments in parallel.
+            Defaults to -1 (all cores).
     Returns:
         dict: Nouveau dictionnaire avec les métriques HRV pour chaque segment.
     """
 
     hrv_metrics_dict = {}
     
-    data_frames = []
+    rows = []
 
+    tasks = []
     for participant, methods in cleaned_segments.items():
         hrv_metrics_dict[participant] = {}
         for method, segments in methods.items():
@@ -55,23 +61,23 @@ def multi_extract_hrv_metrics(cleaned_segments, segments_of_interest, cleaning_m
             hrv_metrics_dict[participant][method] = {}
             for segment_name, segment_data in segments.items():
                 if segment_name in segments_of_interest:
-                    if verbose:
-                        print(f"Actually extracting HRV metrics of segment {segment_name} from participant {participant}")
-                    hrv_metrics, HR = extract_metrics_hrv(segment_data, method='neurokit', fs=250)
-                    hrv_metrics_dict[participant][method][segment_name] = hrv_metrics
-                    HR_mean = sum(HR) / len(HR)
-                    flat_metrics = pd.DataFrame({
-                        'Participant': [participant],
-                        'Segment': [segment_name],
-                        'MeanHR': HR_mean
-                    })
-                    hrv_metrics_df = pd.DataFrame(hrv_metrics, index=[0])
-                    combined_df = pd.concat([flat_metrics, hrv_metrics_df], axis=1)
-                    data_frames.append(combined_df)
+                    tasks.append((participant, method, segment_name, segment_data))
 
+    # Segments are independent, extract them in parallel (joblib prints progress when verbose)
+    results = Parallel(n_jobs=n_jobs, backend='loky', verbose=10 if verbose else 0)(
+        delayed(extract_metrics_hrv)(segment_data, method='neurokit', fs=250) for _, _, _, segment_data in tasks
+    )
 
-    df_hrv = pd.concat(data_frames, ignore_index=True)
-    df_hrv.set_index(['Participant', 'Segment'], inplace=True)
+    for (participant, method, segment_name, _), (hrv_metrics, HR) in zip(tasks, results):
+        hrv_metrics_dict[participant][method][segment_name] = hrv_metrics
+        rows.append({
+            'Participant': participant,
+            'Segment': segment_name,
+            'MeanHR': HR.mean(),
+            **hrv_metrics.iloc[0].to_dict()
+        })
+
+    df_hrv = pd.DataFrame(rows).set_index(['Participant', 'Segment'])
 
     if export:
         df_hrv.to_csv("HRV_metrics.csv", index=True, sep=";")
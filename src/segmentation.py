@@ -1,6 +1,85 @@
+import os
+import glob
+import json
+import shutil
+import functools
+from collections.abc import MutableMapping
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import neurokit2 as nk
 
+CACHE_MANIFEST = "_manifest.json"
+CACHE_VERSION = 1
+
+_ECG_CLEAN_METHODS = {
+    'neurokit': nk.ecg_clean,
+    'pantompkins1985': functools.partial(nk.ecg_clean, method="pantompkins1985"),
+    'hamilton2002': functools.partial(nk.ecg_clean, method="hamilton2002"),
+    'elgendi2010': functools.partial(nk.ecg_clean, method="elgendi2010"),
+    'engzeemod2012': functools.partial(nk.ecg_clean, method="engzeemod2012"),
+    'vg': functools.partial(nk.ecg_clean, method="vg"),
+    'biosppy': functools.partial(nk.ecg_clean, method="biosppy")
+}
+
+class SegmentView(MutableMapping):
+    """
+    Dictionary-like view of ECG segments. Segments found by segmentation_ecg are stored as lists of
+    (lo, hi) row ranges of the ECG DataFrame and only sliced out when accessed; segments assigned
+    afterwards are stored as the DataFrame given.
+
+    Args:
+        ecg_df (pd.DataFrame): DataFrame containing the ECG data.
+        bounds (dict): Segment names mapped to lists of (lo, hi) row ranges.
+    """
+    def __init__(self, ecg_df, bounds):
+        self.ecg_df = ecg_df
+        self.bounds = bounds
+        # Segments made of several ranges (e.g. C.1) are concatenated once, on first access
+        self._combined = {}
+
+    def __getitem__(self, segment_name):
+        bounds = self.bounds[segment_name]
+        if isinstance(bounds, pd.DataFrame):
+            return bounds
+        if not bounds:
+            return pd.DataFrame()
+        if len(bounds) == 1:
+            lo, hi = bounds[0]
+            return self.ecg_df.iloc[lo:hi]
+        if segment_name not in self._combined:
+            self._combined[segment_name] = pd.concat([self.ecg_df.iloc[lo:hi] for lo, hi in bounds])
+        return self._combined[segment_name]
+
+    def __setitem__(self, segment_name, segment):
+        """Accepts either a DataFrame or a list of (lo, hi) row ranges of ecg_df."""
+        if isinstance(segment, pd.DataFrame):
+            self.bounds[segment_name] = segment
+        elif isinstance(segment, list) and all(isinstance(b, tuple) and len(b) == 2 for b in segment):
+            self.bounds[segment_name] = segment
+        else:
+            raise TypeError(f"Segment {segment_name} must be a DataFrame or a list of (lo, hi) row ranges.")
+        self._combined.pop(segment_name, None)
+
+    def __delitem__(self, segment_name):
+        del self.bounds[segment_name]
+        self._combined.pop(segment_name, None)
+
+    def __iter__(self):
+        return iter(self.bounds)
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def segment_length(self, segment_name):
+        """Number of ECG samples in a segment, computed from its bounds without slicing."""
+        bounds = self.bounds[segment_name]
+        if isinstance(bounds, pd.DataFrame):
+            return len(bounds)
+        return sum(max(hi - lo, 0) for lo, hi in bounds)
+
 def segmentation_ecg(ecg_df, log_event_df):
     """
     Segments the ECG data based on the event timestamps.
@@ -10,10 +89,21 @@ def segmentation_ecg(ecg_df, log_event_df):
         log_event_df (pd.DataFrame): DataFrame containing the event timestamps.
 
     Returns:
-        dict: Dictionary of ECG DataFrames segmented per experiment's events.
+        SegmentView: Dictionary-like view of ECG DataFrames segmented per experiment's events.
     """
     segments = {}
     events = log_event_df['events'].unique()
+
+    # First timestamp of each event, and ECG timestamps (monotonic within an acquisition)
+    first_events = log_event_df.drop_duplicates('events')
+    event_to_ts = dict(zip(first_events['events'], first_events['timestamp_ms']))
+    event_set = set(events)
+    ts = ecg_df['timestamp_ms'].to_numpy()
+
+    def slice_ecg(begin_time, end_time):
+        lo = int(np.searchsorted(ts, begin_time, side='left'))
+        hi = int(np.searchsorted(ts, end_time, side='right'))
+        return [(lo, hi)]
     
     order_of_conditions = []
     condition = ''
@@ -27,39 +117,32 @@ def segmentation_ecg(ecg_df, log_event_df):
             if condition in condition_prefixes and condition not in order_of_conditions:
                 order_of_conditions.append(condition)
 
-            begin_time = log_event_df[log_event_df['events'] == event]['timestamp_ms'].values[0]
+            begin_time = event_to_ts[event]
             end_event = event_name + '_end'
             
-            if end_event in log_event_df['events'].values:
-                end_time = log_event_df[log_event_df['events'] == end_event]['timestamp_ms'].values[0]
-                segment = ecg_df[(ecg_df['timestamp_ms'] >= begin_time) & (ecg_df['timestamp_ms'] <= end_time)]
-                segments[event_name] = segment
-            elif end_event not in log_event_df['events'].values:
+            if end_event in event_set:
+                end_time = event_to_ts[end_event]
+                segments[event_name] = slice_ecg(begin_time, end_time)
+            elif end_event not in event_set:
                 name_condition = end_event.split('_')
                 end_condition = name_condition[0] + '_end'
-                end_time = log_event_df[log_event_df['events'] == end_condition]['timestamp_ms'].values[0]
-                segment = ecg_df[(ecg_df['timestamp_ms'] >= begin_time) & (ecg_df['timestamp_ms'] <= end_time)]
-                segments[event_name] = segment
+                end_time = event_to_ts[end_condition]
+                segments[event_name] = slice_ecg(begin_time, end_time)
                 
                 if event_name == 'fixation_cross':
                     begin_time_v2 = begin_time + 30000  # +30 seconds
                     end_time_v2 = end_time - 30000  # -30 seconds
-                    segment_v2 = ecg_df[(ecg_df['timestamp_ms'] >= begin_time_v2) & (ecg_df['timestamp_ms'] <= end_time_v2)]
-                    segments[event_name + '_v2'] = segment_v2
+                    segments[event_name + '_v2'] = slice_ecg(begin_time_v2, end_time_v2)
 
     def combine_phases(prefix, start_phase, end_phase):
-        combined_segment = pd.DataFrame()
-        for phase in range(start_phase, end_phase + 1):
-            phase_name = f"{prefix}_phase_{phase}"
-            if phase_name in segments:
-                combined_segment = pd.concat([combined_segment, segments[phase_name]])
-        return combined_segment
+        phase_names = [f"{prefix}_phase_{phase}" for phase in range(start_phase, end_phase + 1)]
+        return [bounds for phase_name in phase_names if phase_name in segments for bounds in segments[phase_name]]
 
     for condition in order_of_conditions:
         segments[f'{condition}.1'] = combine_phases(condition, 1, 6)
         segments[f'{condition}.2'] = combine_phases(condition, 7, 12)
 
-    return segments
+    return SegmentView(ecg_df, segments)
 
 
 def measure_segment_duration(segment):
@@ -88,27 +171,35 @@ def clean_segment(segment, sampling_rate, method):
         method (str): Cleaning method to use.
     
     Returns:
-        DataFrame: Clean ECG segment.
-    """
-    methods_dict = {
-        'neurokit': nk.ecg_clean,
-        'pantompkins1985': lambda sig, sr: nk.ecg_clean(sig, method="pantompkins1985", sampling_rate=sr),
-        'hamilton2002': lambda sig, sr: nk.ecg_clean(sig, method="hamilton2002", sampling_rate=sr),
-        'elgendi2010': lambda sig, sr: nk.ecg_clean(sig, method="elgendi2010", sampling_rate=sr),
-        'engzeemod2012': lambda sig, sr: nk.ecg_clean(sig, method="engzeemod2012", sampling_rate=sr),
-        'vg': lambda sig, sr: nk.ecg_clean(sig, method="vg", sampling_rate=sr),
-        'biosppy': lambda sig, sr: nk.ecg_clean(sig, method="biosppy", sampling_rate=sr)
-    }
-
-    if method not in methods_dict:
+        DataFrame: Clean ECG segment (timestamp_ms and EcgWaveform columns only).
+    """
+    if method not in _ECG_CLEAN_METHODS:
         raise ValueError(f"Method {method} is not supported.")
     
-    cleaned_segment = segment.copy()
-    cleaned_segment['EcgWaveform'] = nk.signal_sanitize(cleaned_segment['EcgWaveform'])
-    cleaned_segment['EcgWaveform'] = methods_dict[method](segment['EcgWaveform'], sampling_rate)
-    rpeaks = nk.ecg_peaks(cleaned_segment['EcgWaveform'], sampling_rate, method='neurokit', correct_artifacts=True)
+    ecg_signal = np.ascontiguousarray(segment['EcgWaveform'].to_numpy(), dtype=np.float32)
+    sanitized = nk.signal_sanitize(ecg_signal)
+    # NeuroKit filters upcast to float64, bring the result back to float32
+    cleaned_signal = np.asarray(_ECG_CLEAN_METHODS[method](sanitized, sampling_rate=sampling_rate), dtype=np.float32)
+    cleaned_segment = pd.DataFrame({
+        'timestamp_ms': segment['timestamp_ms'].to_numpy(),
+        'EcgWaveform': cleaned_signal
+    }, index=segment.index)
     
-    return cleaned_segment, rpeaks
+    return cleaned_segment
+
+def detect_rpeaks(cleaned_segment, sampling_rate):
+    """
+    Detects R-peaks in a cleaned ECG segment. Kept separate from clean_segment so that peaks
+    are only computed when they are actually used.
+    
+    Args:
+        cleaned_segment (DataFrame): Cleaned ECG segment, as returned by clean_segment
+        sampling_rate (int): Sampling rate of the ECG signal
+    
+    Returns:
+        tuple: R-peak signals DataFrame and info dictionary from nk.ecg_peaks.
+    """
+    return nk.ecg_peaks(cleaned_segment['EcgWaveform'], sampling_rate, method='neurokit', correct_artifacts=True)
 
 def remove_short_segments(all_segments, cleaned_segments, min_length=1000, verbose=False):
     """
@@ -126,9 +217,14 @@ def remove_short_segments(all_segments, cleaned_segments, min_length=1000, verbo
         DataFrame: A dataframe containing the rest of all uncleaned segments, free from too shorts segments
     """    
     for participant in list(all_segments.keys()):
-        for segment in list(all_segments[participant].keys()):
-            ecg_signal = all_segments[participant][segment]
-            if ecg_signal is None or len(ecg_signal) < min_length:
+        participant_segments = all_segments[participant]
+        for segment in list(participant_segments.keys()):
+            if isinstance(participant_segments, SegmentView):
+                segment_length = participant_segments.segment_length(segment)
+            else:
+                ecg_signal = participant_segments[segment]
+                segment_length = 0 if ecg_signal is None else len(ecg_signal)
+            if segment_length < min_length:
                 del all_segments[participant][segment]
                 if verbose == True:
                     print(f"Deleted this segment : {segment} from subject {participant}")
@@ -142,4 +238,109 @@ def remove_short_segments(all_segments, cleaned_segments, min_length=1000, verbo
                     if verbose == True:
                         print(f"Deleted this segment : {segment} from subject {participant}, cleaned with : {method} method")
 
-    return all_segments, cleaned_segments
\ No newline at end of file
+    return all_segments, cleaned_segments
+
+def source_manifest(source_dir):
+    """
+    Lists the CSV files of the source data with their modification times.
+
+    Args:
+        source_dir (str): Root directory of the raw data.
+
+    Returns:
+        dict: CSV paths relative to source_dir mapped to their modification time (ns).
+    """
+    csv_files = glob.glob(os.path.join(source_dir, '**', '*.csv'), recursive=True)
+    return {os.path.relpath(path, source_dir): os.stat(path).st_mtime_ns for path in sorted(csv_files)}
+
+def _cache_manifest(source_dir, params):
+    return {'version': CACHE_VERSION, 'params': params or {}, 'sources': source_manifest(source_dir)}
+
+def save_segments(segments, out_dir, source_dir, params=None):
+    """
+    Saves cleaned ECG segments to Parquet, as {out_dir}/{participant}/{method}/{segment}.parquet,
+    so that later runs can skip the CSV loading, segmentation and cleaning steps.
+    The cache is written to a temporary directory and only swapped in for out_dir once complete,
+    together with a manifest of the source CSVs and pipeline parameters it was built from.
+
+    Args:
+        segments (dict): Dictionary of cleaned ECG segments per participant and preprocessing method.
+        out_dir (str): Root directory of the Parquet cache.
+        source_dir (str): Root directory of the raw data the segments were computed from.
+        params (dict, optional): JSON-serialisable pipeline parameters (cleaning methods, sampling rate, ...).
+
+    Raises:
+        ValueError: If out_dir exists, is not empty and is not a previous segment cache.
+    """
+    out_dir = os.path.normpath(out_dir)
+    if os.path.exists(out_dir) and os.listdir(out_dir) and not os.path.isfile(os.path.join(out_dir, CACHE_MANIFEST)):
+        raise ValueError(f"{out_dir} is not empty and is not a segment cache, refusing to overwrite it")
+    tmp_dir = out_dir + ".tmp"
+    old_dir = out_dir + ".old"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for participant, methods in segments.items():
+        for method, method_segments in methods.items():
+            method_dir = os.path.join(tmp_dir, participant, method)
+            os.makedirs(method_dir, exist_ok=True)
+            for segment_name, segment_df in method_segments.items():
+                segment_path = os.path.join(method_dir, f"{segment_name}.parquet")
+                segment_df.to_parquet(segment_path, engine='pyarrow', compression='zstd', use_dictionary=True)
+
+    os.makedirs(tmp_dir, exist_ok=True)
+    with open(os.path.join(tmp_dir, CACHE_MANIFEST), 'w') as f:
+        json.dump(_cache_manifest(source_dir, params), f)
+
+    # Move the previous cache aside rather than deleting it first, so out_dir is only
+    # missing between two renames and never holds a partially written cache
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+def segments_cache_is_fresh(out_dir, source_dir, params=None):
+    """
+    Checks that a segment cache is complete and was built from the current source CSVs
+    with the same pipeline parameters.
+
+    Args:
+        out_dir (str): Root directory of the Parquet cache.
+        source_dir (str): Root directory of the raw data.
+        params (dict, optional): Pipeline parameters the cache must have been built with.
+
+    Returns:
+        bool: True if the cache can be loaded instead of recomputing the segments.
+    """
+    manifest_path = os.path.join(out_dir, CACHE_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return False
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    # Round-trip through JSON so that tuples and lists compare equal
+    return manifest == json.loads(json.dumps(_cache_manifest(source_dir, params)))
+
+def load_segments(out_dir, participants=None):
+    """
+    Loads ECG segments previously written by save_segments (the manifest file is ignored by pyarrow.dataset).
+
+    Args:
+        out_dir (str): Root directory of the Parquet cache.
+        participants (list, optional): Participants to load. Defaults to None (all participants).
+
+    Returns:
+        dict: Dictionary of cleaned ECG segments per participant and preprocessing method.
+    """
+    partitioning = ds.partitioning(pa.schema([('participant', pa.string()), ('method', pa.string())]))
+    dataset = ds.dataset(out_dir, format='parquet', partitioning=partitioning)
+    participant_filter = ds.field('participant').isin(participants) if participants is not None else None
+
+    segments = {}
+    for fragment in dataset.get_fragments(filter=participant_filter):
+        keys = ds.get_partition_keys(fragment.partition_expression)
+        segment_name = os.path.splitext(os.path.basename(fragment.path))[0]
+        # Each file keeps its own pandas metadata (index, dtypes)
+        segment_df = pq.read_table(fragment.path).to_pandas()
+        segments.setdefault(keys['participant'], {}).setdefault(keys['method'], {})[segment_name] = segment_df
+
+    return segments